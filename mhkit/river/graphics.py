@@ -43,7 +43,7 @@ def _xy_plot(x, y, fmt='.', label=None, xlabel=None, ylabel=None, title=None,
     if title:
         ax.set_title(title)
     
-    plt.tight_layout()
+    ax.figure.tight_layout()
     
     return ax
 
@@ -77,7 +77,7 @@ def plot_flow_duration_curve(D, F, label=None, ax=None):
     
     ax = _xy_plot(temp['D'], temp['F'], fmt='-', label=label, xlabel='Discharge [$m^3/s$]',
              ylabel='Exceedance Probability', ax=ax)
-    plt.xscale('log')
+    ax.set_xscale('log')
 
     return ax
 
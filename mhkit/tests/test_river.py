@@ -1,18 +1,53 @@
 import unittest
+from unittest.mock import patch
 from os.path import abspath, dirname, join, isfile, normpath, relpath
 import os
+import shutil
+import tempfile
+import requests
 import numpy as np
 import pandas as pd
-import matplotlib.pylab as plt
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
 import mhkit.river as river
 import netCDF4
-from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_array_almost_equal, assert_allclose
 from pandas.testing import assert_frame_equal
 import scipy.interpolate as interp
+from scipy.spatial import Delaunay
 
 
 testdir = dirname(abspath(__file__))
 datadir = normpath(join(testdir,'..','..','examples','data','river'))
+usgsdatadir = join(testdir, 'data', 'usgs')
+# Set MHKIT_LIVE_TESTS to also run the request tests against the live USGS service
+LIVE = bool(os.environ.get('MHKIT_LIVE_TESTS'))
+
+
+class _FixtureResponse(object):
+    def __init__(self, text):
+        self.text = text
+
+
+_requests_get = requests.get
+
+
+_usgs_responses = {
+    'https://waterservices.usgs.gov/nwis/dv/?format=json&sites=15515500'
+    '&startDT=2009-08-01&endDT=2009-08-10&statCd=00003&parameterCd=00060'
+    '&siteStatus=all': 'synthetic_usgs_15515500_Aug2009_daily.json',
+    'https://waterservices.usgs.gov/nwis/iv/?format=json&sites=15515500'
+    '&startDT=2009-08-01&endDT=2009-08-10&parameterCd=00060'
+    '&siteStatus=all': 'synthetic_usgs_15515500_Aug2009_instantaneous.json'}
+
+
+def _fixture_get(url, proxies=None):
+    # Serve USGS requests from the synthetic WaterML fixtures in usgsdatadir. 
+    # They only match the shape of the real responses, not their values.
+    file_name = join(usgsdatadir, _usgs_responses[url])
+    with open(file_name) as json_file:
+        return _FixtureResponse(json_file.read())
 
 
 class TestPerformance(unittest.TestCase):
@@ -55,8 +90,7 @@ class TestPerformance(unittest.TestCase):
         
         TSR = river.performance.tip_speed_ratio(np.asarray(rotor_speed)/60,rotor_diameter,inflow_speed)
 
-        for i,j in zip(TSR,TSR_answer):
-            self.assertAlmostEqual(i,j,delta=0.05)
+        assert_allclose(TSR, TSR_answer, atol=0.05)
 
     def test_power_coefficient(self):
         # data obtained from power performance report of wind turbine
@@ -68,8 +102,7 @@ class TestPerformance(unittest.TestCase):
         
         Cp = river.performance.power_coefficient(power_out*1000,inflow_speed,capture_area,rho)
 
-        for i,j in zip(Cp,Cp_answer):
-            self.assertAlmostEqual(i,j,places=2)        
+        assert_allclose(Cp, Cp_answer, atol=0.005)
 
 class TestResource(unittest.TestCase):
 
@@ -81,10 +114,22 @@ class TestResource(unittest.TestCase):
               
         self.results = pd.read_csv(join(datadir, 'tanana_test_results.csv'), index_col=0, 
                               parse_dates=True)
+        
+        self.f = river.resource.exceedance_probability(self.data.Q)
+        
+        # First order polynomial on a line 10 times greater than the x values
+        self.p_10, _ = river.resource.polynomial_fit(np.arange(9), 
+                                                     10*np.arange(9), 1)
+        
+        self.rng = np.random.default_rng(12345)
+        
+        self.fig = plt.figure()
+        self.plotdir = tempfile.mkdtemp()
 
     @classmethod
     def tearDownClass(self):
-        pass
+        plt.close(self.fig)
+        shutil.rmtree(self.plotdir)
     
     def test_Froude_number(self):
         v = 2
@@ -116,30 +161,30 @@ class TestResource(unittest.TestCase):
     def test_discharge_to_velocity(self):
         # Create arbitrary discharge between 0 and 8(N=9)
         Q = pd.Series(np.arange(9))
-        # Calculate a first order polynomial on an DV_Curve x=y line 10 times greater than the Q values
-        p, r2 = river.resource.polynomial_fit(np.arange(9), 10*np.arange(9),1)
+        # DV_Curve is an x=y line 10 times greater than the Q values
         # Becuase the polynomial line fits perfect we should expect the V to equal 10*Q
-        V = river.resource.discharge_to_velocity(Q, p)
-        self.assertAlmostEqual(np.sum(10*Q - V['V']), 0.00, places=2 )
+        V = river.resource.discharge_to_velocity(Q, self.p_10)
+        assert_allclose(V['V'].to_numpy(), 10*Q, atol=1e-2)
         
     def test_velocity_to_power(self):
-        # Calculate a first order polynomial on an DV_Curve x=y line 10 times greater than the Q values
-        p, r2 = river.resource.polynomial_fit(np.arange(9), 10*np.arange(9),1)
+        # DV_Curve is an x=y line 10 times greater than the Q values
         # Becuase the polynomial line fits perfect we should expect the V to equal 10*Q
-        V = river.resource.discharge_to_velocity(pd.Series(np.arange(9)), p)
-        # Calculate a first order polynomial on an VP_Curve x=y line 10 times greater than the V values
-        p2, r22 = river.resource.polynomial_fit(np.arange(9), 10*np.arange(9),1)
+        V = river.resource.discharge_to_velocity(pd.Series(np.arange(9)), self.p_10)
+        # VP_Curve is the same x=y line 10 times greater than the V values
+        p2 = self.p_10
+        V_arr = V['V'].to_numpy()
         # Set cut in/out to exclude 1 bin on either end of V range
-        cut_in  = V['V'][1]
-        cut_out = V['V'].iloc[-2]  
+        cut_in  = V_arr[1]
+        cut_out = V_arr[-2]
         # Power should be 10x greater and exclude the ends of V
         P = river.resource.velocity_to_power(V['V'], p2, cut_in, cut_out)
+        P_arr = P['P'].to_numpy()
         #Cut in power zero
-        self.assertAlmostEqual(P['P'][0], 0.00, places=2 )
+        self.assertAlmostEqual(P_arr[0], 0.00, places=2 )
         #Cut out power zero
-        self.assertAlmostEqual(P['P'].iloc[-1], 0.00, places=2 )
+        self.assertAlmostEqual(P_arr[-1], 0.00, places=2 )
         # Middle 10x greater than velocity
-        self.assertAlmostEqual((P['P'][1:-1] - 10*V['V'][1:-1] ).sum(), 0.00, places=2 )
+        assert_allclose(P_arr[1:-1], 10*V_arr[1:-1], atol=1e-2)
 
 
     def test_energy_produced(self):
@@ -152,84 +197,72 @@ class TestResource(unittest.TestCase):
         # for a normal distribution of Power EP = mean *seconds
         mu=5
         sigma=1
-        power_dist = pd.Series(np.random.normal(mu, sigma, 10000))
+        power_dist = pd.Series(self.rng.normal(mu, sigma, 2000))
         EP2 = river.resource.energy_produced(power_dist, seconds)
 #        import ipdb; ipdb.set_trace()
         self.assertAlmostEqual(EP2, mu*seconds, places=1 )
 
 
     def test_plot_flow_duration_curve(self):
-        filename = abspath(join(testdir, 'river_plot_flow_duration_curve.png'))
-        if isfile(filename):
-            os.remove(filename)
-            
-        f = river.resource.exceedance_probability(self.data.Q)
-        plt.figure()
-        river.graphics.plot_flow_duration_curve(self.data['Q'], f['F'])
-        plt.savefig(filename, format='png')
-        plt.close()
+        filename = join(self.plotdir, 'river_plot_flow_duration_curve.png')
+        
+        f = self.f
+        self.fig.clear()
+        river.graphics.plot_flow_duration_curve(self.data['Q'], f['F'],
+            ax=self.fig.gca())
+        self.fig.savefig(filename, format='png')
         
         self.assertTrue(isfile(filename))
         
     def test_plot_power_duration_curve(self):
-        filename = abspath(join(testdir, 'river_plot_power_duration_curve.png'))
-        if isfile(filename):
-            os.remove(filename)
+        filename = join(self.plotdir, 'river_plot_power_duration_curve.png')
         
-        f = river.resource.exceedance_probability(self.data.Q)
-        plt.figure()
-        river.graphics.plot_flow_duration_curve(self.results['P_control'], f['F'])
-        plt.savefig(filename, format='png')
-        plt.close()
+        f = self.f
+        self.fig.clear()
+        river.graphics.plot_flow_duration_curve(self.results['P_control'], f['F'],
+            ax=self.fig.gca())
+        self.fig.savefig(filename, format='png')
         
         self.assertTrue(isfile(filename))
         
     def test_plot_velocity_duration_curve(self):
-        filename = abspath(join(testdir, 'river_plot_velocity_duration_curve.png'))
-        if isfile(filename):
-            os.remove(filename)
+        filename = join(self.plotdir, 'river_plot_velocity_duration_curve.png')
         
-        f = river.resource.exceedance_probability(self.data.Q)
-        plt.figure()
-        river.graphics.plot_velocity_duration_curve(self.results['V_control'], f['F'])
-        plt.savefig(filename, format='png')
-        plt.close()
+        f = self.f
+        self.fig.clear()
+        river.graphics.plot_velocity_duration_curve(self.results['V_control'], f['F'],
+            ax=self.fig.gca())
+        self.fig.savefig(filename, format='png')
         
         self.assertTrue(isfile(filename))
     
     def test_plot_discharge_timeseries(self):
-        filename = abspath(join(testdir, 'river_plot_discharge_timeseries.png'))
-        if isfile(filename):
-            os.remove(filename)
+        filename = join(self.plotdir, 'river_plot_discharge_timeseries.png')
         
-        plt.figure()
-        river.graphics.plot_discharge_timeseries(self.data['Q'])
-        plt.savefig(filename, format='png')
-        plt.close()
+        self.fig.clear()
+        river.graphics.plot_discharge_timeseries(self.data['Q'],
+            ax=self.fig.gca())
+        self.fig.savefig(filename, format='png')
         
         self.assertTrue(isfile(filename))
         
     def test_plot_discharge_vs_velocity(self):
-        filename = abspath(join(testdir, 'river_plot_discharge_vs_velocity.png'))
-        if isfile(filename):
-            os.remove(filename)
+        filename = join(self.plotdir, 'river_plot_discharge_vs_velocity.png')
         
-        plt.figure()
-        river.graphics.plot_discharge_vs_velocity(self.data['Q'], self.results['V_control'])
-        plt.savefig(filename, format='png')
-        plt.close()
+        self.fig.clear()
+        river.graphics.plot_discharge_vs_velocity(self.data['Q'], self.results['V_control'],
+            ax=self.fig.gca())
+        self.fig.savefig(filename, format='png')
         
         self.assertTrue(isfile(filename))
     
     def test_plot_velocity_vs_power(self):
-        filename = abspath(join(testdir, 'river_plot_velocity_vs_power.png'))
-        if isfile(filename):
-            os.remove(filename)
+        filename = join(self.plotdir, 'river_plot_velocity_vs_power.png')
         
-        plt.figure()
-        river.graphics.plot_velocity_vs_power(self.results['V_control'], self.results['P_control'])
-        plt.savefig(filename, format='png')
-        plt.close()
+        self.fig.clear()
+        river.graphics.plot_velocity_vs_power(self.results['V_control'], self.results['P_control'],
+            ax=self.fig.gca())
+        self.fig.savefig(filename, format='png')
         
         self.assertTrue(isfile(filename))
         
@@ -243,24 +276,30 @@ class TestIO(unittest.TestCase):
         filename= 'turbineTest_map.nc'
         self.d3d_flume_data = netCDF4.Dataset(join(d3ddatadir,filename))
         
+        self.usgs_patch = patch('mhkit.river.io.usgs.requests.get',
+                                side_effect=_fixture_get)
+        self.usgs_patch.start()
+        
     @classmethod
     def tearDownClass(self):
-        pass
+        self.usgs_patch.stop()
+        self.d3d_flume_data.close()
     
     def test_load_usgs_data_instantaneous(self):
         file_name = join(datadir, 'USGS_08313000_Jan2019_instantaneous.json')
         data = river.io.usgs.read_usgs_file(file_name)
         
-        self.assertEqual(data.columns, ['Discharge, cubic feet per second'])
+        self.assertEqual(data.columns.tolist(), ['Discharge, cubic feet per second'])
         self.assertEqual(data.shape, (2972, 1)) # 4 data points are missing
         
     def test_load_usgs_data_daily(self):
         file_name = join(datadir, 'USGS_08313000_Jan2019_daily.json')
         data = river.io.usgs.read_usgs_file(file_name)
 
-        expected_index = pd.date_range('2019-01-01', '2019-01-31', freq='D')
-        self.assertEqual(data.columns, ['Discharge, cubic feet per second'])
-        self.assertEqual((data.index == expected_index.tz_localize('UTC')).all(), True)
+        expected_index = pd.date_range('2019-01-01', '2019-01-31', freq='D', 
+                                       tz='UTC')
+        self.assertEqual(data.columns.tolist(), ['Discharge, cubic feet per second'])
+        self.assertTrue(data.index.equals(expected_index))
         self.assertEqual(data.shape, (31, 1))
 
 
@@ -270,7 +309,7 @@ class TestIO(unittest.TestCase):
                             start_date='2009-08-01',
                             end_date='2009-08-10',
                             data_type='Daily')
-        self.assertEqual(data.columns, ['Discharge, cubic feet per second'])
+        self.assertEqual(data.columns.tolist(), ['Discharge, cubic feet per second'])
         self.assertEqual(data.shape, (10, 1))
     
    
@@ -280,10 +319,21 @@ class TestIO(unittest.TestCase):
                             start_date='2009-08-01',
                             end_date='2009-08-10',
                             data_type='Instantaneous')
-        self.assertEqual(data.columns, ['Discharge, cubic feet per second'])
+        self.assertEqual(data.columns.tolist(), ['Discharge, cubic feet per second'])
         # Every 15 minutes or 4 times per hour
         self.assertEqual(data.shape, (10*24*4, 1))
 
+    @unittest.skipUnless(LIVE, 'live USGS tests disabled')
+    def test_request_usgs_data_live(self):
+        with patch('mhkit.river.io.usgs.requests.get', side_effect=_requests_get):
+            data=river.io.usgs.request_usgs_data(station="15515500",
+                                parameter='00060',
+                                start_date='2009-08-01',
+                                end_date='2009-08-10',
+                                data_type='Daily')
+        self.assertEqual(data.columns.tolist(), ['Discharge, cubic feet per second'])
+        self.assertEqual(data.shape, (10, 1))
+
 
     def test_layer_data(self): 
         data=self.d3d_flume_data
@@ -308,11 +358,9 @@ class TestIO(unittest.TestCase):
         z=1 
         points= river.io.d3d.create_points(x,y,z)
         
-        x=[1,2,3,1,2,3,1,2,3]
-        y=[1,1,1,2,2,2,3,3,3]
-        z=[1,1,1,1,1,1,1,1,1]
+        xx, yy = np.meshgrid([1,2,3], [1,2,3])
         
-        points_array= np.array([ [x_i, y_i, z_i] for x_i, y_i, z_i in zip(x, y, z)]) 
+        points_array= np.column_stack((xx.ravel(), yy.ravel(), np.ones(9)))
         points_expected= pd.DataFrame(points_array, columns=('x','y','z'))
         assert_array_almost_equal(points, points_expected,decimal = 2)  
         
@@ -344,7 +392,7 @@ class TestIO(unittest.TestCase):
         y_test=np.linspace(3, 3, num= 10)
         z_test=np.linspace(1, 1, num= 10)
        
-        test_points = np.array([ [x, y, z] for x, y, z in zip(x_test, y_test, z_test)])
+        test_points = np.column_stack((x_test, y_test, z_test))
         points= pd.DataFrame(test_points, columns=['x','y','z'])
         
         TI= river.io.d3d.turbulent_intensity(data, points, time_step)
@@ -357,9 +405,17 @@ class TestIO(unittest.TestCase):
             TI_data_raw[var] = var_data_df 
             TI_data= points.copy(deep=True)
         
-        for var in TI_vars:    
-            TI_data[var] = interp.griddata(TI_data_raw[var][['x','y','z']],
-                                TI_data_raw[var][var], points[['x','y','z']])
+        # turkin1 is on the w-layer grid and the velocities share the cell
+        # grid, so triangulate each distinct grid only once
+        triangulations = {}
+        for var in TI_vars:
+            xyz = TI_data_raw[var][['x','y','z']].to_numpy()
+            key = xyz.tobytes()
+            if key not in triangulations:
+                triangulations[key] = Delaunay(xyz)
+            interp_f = interp.LinearNDInterpolator(triangulations[key],
+                                                   TI_data_raw[var][var].to_numpy())
+            TI_data[var] = interp_f(points[['x','y','z']].to_numpy())
         
         u_mag=river.io.d3d.unorm(TI_data['ucx'],TI_data['ucy'], TI_data['ucz'])
         turbulent_intensity_expected= np.sqrt(2/3*TI_data['turkin1'])/u_mag
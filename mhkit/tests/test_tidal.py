@@ -3,7 +3,7 @@ from os.path import abspath, dirname, join, isfile, normpath, relpath
 import os
 import numpy as np
 import pandas as pd
-import matplotlib.pylab as plt
+import matplotlib.pyplot as plt
 import mhkit.tidal as tidal
 
 testdir = dirname(abspath(__file__))
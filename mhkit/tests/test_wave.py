@@ -3,7 +3,7 @@ from pandas.testing import assert_frame_equal
 from numpy.testing import assert_allclose
 from scipy.interpolate import interp1d
 from random import seed, randint
-import matplotlib.pylab as plt
+import matplotlib.pyplot as plt
 from datetime import datetime
 import xarray.testing as xrt
 import mhkit.wave as wave
@@ -8,7 +8,6 @@ from mhkit.river.graphics import _xy_plot
 from mhkit.river.resource import exceedance_probability
 import calendar
 from matplotlib import gridspec
-from matplotlib import pylab
 import datetime
 
 
@@ -4,7 +4,7 @@ import xarray
 import types
 from scipy.stats import binned_statistic_2d as _binned_statistic_2d
 from mhkit import wave
-import matplotlib.pylab as plt
+import matplotlib.pyplot as plt
 from os.path import join
 
 def capture_length(P, J):